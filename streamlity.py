@@ -1,93 +1,309 @@
+import hashlib
+import importlib.util
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
 import streamlit as st
 import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+REQUIRED_COLUMNS = ['Date', 'Currency', 'Exchange', 'Type', 'Amount']
+KEY_COLUMNS = ['Date', 'Currency', 'Exchange', 'Type']
+CATEGORY_COLUMNS = ['Currency', 'Exchange', 'Type']
+MAX_CATEGORIES = 1024
+PREVIEW_ROWS = 1000
+# Date is stored as midnight datetime64; show it as a plain date in every table.
+DATE_COLUMN_CONFIG = {"Date": st.column_config.DateColumn("Date")}
+
+# Parsed uploads are kept here as Parquet, keyed by a hash of the file contents.
+CACHE_DIR = Path(__file__).resolve().parent / '.cache'
+# Bump whenever load_excel_data changes how frames are validated or normalized,
+# so Parquet files written by older code are no longer read.
+CACHE_VERSION = 1
+# st.cache_data is shared by every session, so each cached function keeps only this many entries.
+CACHE_MAX_ENTRIES = 16
+# Parquet files of the current version kept on disk; older ones are deleted after each write.
+CACHE_MAX_FILES = 64
+
+# pandas ships the calamine engine from 2.2 onwards; older versions read through python-calamine directly.
+PANDAS_HAS_CALAMINE = tuple(int(part) for part in pd.__version__.split('.')[:2]) >= (2, 2)
+# Without python-calamine (e.g. no wheel for the platform) xlsx files are streamed through openpyxl.
+HAS_PYTHON_CALAMINE = importlib.util.find_spec('python_calamine') is not None
 
 # ---------------------------
 # Data Processing Functions
 # ---------------------------
-@st.cache_data(show_spinner="Loading file...")
-def load_excel_data(file) -> pd.DataFrame:
+def read_excel_openpyxl(file) -> pd.DataFrame:
+    """
+    Stream the first sheet through openpyxl's read-only mode and collect only
+    the required columns, without materializing the rest of the sheet.
+    """
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        wanted = [(i, col) for i, col in enumerate(header) if col in REQUIRED_COLUMNS]
+        columns = {col: [] for _, col in wanted}
+        for row in rows:
+            for i, col in wanted:
+                columns[col].append(row[i] if i < len(row) else None)
+        return pd.DataFrame(columns)
+    finally:
+        workbook.close()
+
+def read_excel_file(file) -> pd.DataFrame:
+    """
+    Parse the first sheet of the Excel file with the Rust-based calamine reader.
+    Only the required columns are kept; any other columns in the sheet are skipped.
     """
-    Read and process the Excel file using pandas.
+    if not HAS_PYTHON_CALAMINE:
+        return read_excel_openpyxl(file)
+    if PANDAS_HAS_CALAMINE:
+        return pd.read_excel(file, engine="calamine", usecols=lambda col: col in REQUIRED_COLUMNS)
+
+    from python_calamine import CalamineWorkbook
+    header, *rows = CalamineWorkbook.from_filelike(file).get_sheet_by_index(0).to_python()
+    # Transpose once and only build the required columns, instead of a frame of the whole sheet
+    columns = list(zip(*rows)) if rows else [()] * len(header)
+    return pd.DataFrame({col: columns[i] for i, col in enumerate(header) if col in REQUIRED_COLUMNS})
+
+def write_parquet_cache(df: pd.DataFrame, cache_path: Path) -> None:
+    """
+    Store a parsed file in the Parquet cache so later sessions skip Excel parsing.
+    The file is written under a temporary name and moved into place, so a
+    concurrent reader never sees a partial file. Caching is best effort.
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix='.tmp', delete=False)
+    except OSError:
+        return
+    try:
+        with tmp:
+            df.to_parquet(tmp, compression='zstd', index=False)
+        os.replace(tmp.name, cache_path)
+    except Exception:
+        # Don't leave half-written temporary files behind
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
+        return
+    prune_parquet_cache()
+
+def prune_parquet_cache() -> None:
+    """
+    Delete cache files written by other CACHE_VERSIONs and all but the newest
+    CACHE_MAX_FILES current ones. Files another session removes first are skipped.
+    """
+    suffix = f"-v{CACHE_VERSION}.parquet"
+    current = []
+    for path in CACHE_DIR.glob('*.parquet'):
+        try:
+            if path.name.endswith(suffix):
+                current.append((path.stat().st_mtime, path))
+            else:
+                path.unlink()
+        except OSError:
+            pass
+    current.sort(reverse=True)
+    for _, path in current[CACHE_MAX_FILES:]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+def file_digest(file) -> str:
+    """
+    Return a blake2b hash of the uploaded file's contents. Identical
+    spreadsheets get the same digest, whichever session uploads them.
+    The cached functions below take this digest and pass the upload or frame
+    as an underscore argument, so st.cache_data keys on the digest instead of
+    hashing the data on every rerun.
+    """
+    return hashlib.blake2b(file.getvalue(), digest_size=16).hexdigest()
+
+@st.cache_data(show_spinner="Loading file...", max_entries=CACHE_MAX_ENTRIES)
+def load_excel_data(digest: str, _file) -> pd.DataFrame | None:
+    """
+    Read and process the Excel file using pandas with the calamine engine.
     Expects columns: Date, Currency, Exchange, Type, and Amount.
+    Files parsed before are read back from the on-disk Parquet cache.
+    Returns None, after reporting the problem, when required columns are missing.
     """
     try:
-        df = pd.read_excel(file)
-        # Ensure required columns exist
-        for col in ['Date', 'Currency', 'Exchange', 'Type', 'Amount']:
-            if col not in df.columns:
-                raise KeyError(f"Expected column '{col}' not found. Found columns: {df.columns.tolist()}")
-        df['Date'] = pd.to_datetime(df['Date']).dt.date
-        df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce')
+        cache_path = CACHE_DIR / f"{digest}-v{CACHE_VERSION}.parquet"
+        if cache_path.exists():
+            return pd.read_parquet(cache_path)
+        df = read_excel_file(_file)
+        # Validate the schema up front so the processing steps can assume it
+        missing = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+        if missing:
+            st.error(f"Expected columns {missing} not found in {getattr(_file, 'name', 'the file')}. Found columns: {df.columns.tolist()}")
+            return None
+        # calamine already returns typed columns when the cells hold real dates and numbers,
+        # so the conversion passes only run for text cells.
+        if not pd.api.types.is_datetime64_any_dtype(df['Date']):
+            df['Date'] = pd.to_datetime(df['Date'])
+        # Day-resolution datetime64 keeps Date as int64 under the hood instead of Python date objects
+        df['Date'] = df['Date'].dt.normalize()
+        if not pd.api.types.is_float_dtype(df['Amount']):
+            df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce')
+        # Key columns as Arrow strings; low-cardinality ones as categoricals so groupby/pivot work on integer codes
+        for col in CATEGORY_COLUMNS:
+            values = df[col].astype('string[pyarrow]')
+            df[col] = values.astype('category') if values.nunique() < MAX_CATEGORIES else values
+        write_parquet_cache(df, cache_path)
         return df
     except Exception as e:
         st.error(f"Error loading file: {e}")
         raise
 
-def create_pivot_table(df: pd.DataFrame) -> pd.DataFrame:
+def load_excel_files(file1, file2):
     """
-    Create a pivot table that sums the 'Amount' per Date and Currency,
-    with separate columns for each combination of Exchange and Type.
+    Load both uploaded files concurrently. calamine's Rust parser releases the
+    GIL but building the pandas frames does not, so the reads only partly overlap.
+    Returns a (digest, DataFrame) pair per file. The pairs are kept in
+    st.session_state by upload id, so later reruns reuse them without hashing
+    the uploads or unpickling cached copies.
     """
-    try:
-        pivot_df = df.pivot_table(
-            values='Amount',
-            index=['Date', 'Currency'],
-            columns=['Exchange', 'Type'],
-            aggfunc='sum',
-            fill_value=0
-        )
-        pivot_df.reset_index(inplace=True)
-        return pivot_df
-    except Exception as e:
-        st.error(f"Error creating pivot table: {e}")
-        raise
+    keys = [f"df:{file1.file_id}", f"df:{file2.file_id}"]
+    # Drop frames of earlier uploads that have been replaced
+    for key in [key for key in st.session_state if str(key).startswith("df:") and key not in keys]:
+        del st.session_state[key]
+    if not all(key in st.session_state for key in keys):
+        digests = file_digest(file1), file_digest(file2)
+        # Worker threads need the script context to show spinners and errors.
+        with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+            future1 = executor.submit(load_excel_data, digests[0], file1)
+            future2 = executor.submit(load_excel_data, digests[1], file2)
+            frames = future1.result(), future2.result()
+        # A file without the required columns has already been reported; nothing can be compared.
+        if any(df is None for df in frames):
+            st.stop()
+        st.session_state[keys[0]] = (digests[0], frames[0])
+        st.session_state[keys[1]] = (digests[1], frames[1])
+    return st.session_state[keys[0]], st.session_state[keys[1]]
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def get_date_bounds(digest: str, _df: pd.DataFrame):
+    """
+    Return the first and last Date of a loaded file.
+    """
+    dates = _df['Date']
+    return dates.min().date(), dates.max().date()
+
+def align_categories(df1: pd.DataFrame, df2: pd.DataFrame):
+    """
+    Give the categorical key columns of both files the same categories.
+    With a shared dictionary the codes mean the same thing in both frames, so
+    combining them stays on integer codes instead of falling back to strings.
+    """
+    aligned1, aligned2 = {}, {}
+    for col in CATEGORY_COLUMNS:
+        if isinstance(df1[col].dtype, pd.CategoricalDtype) and isinstance(df2[col].dtype, pd.CategoricalDtype):
+            categories = df1[col].cat.categories.union(df2[col].cat.categories)
+            aligned1[col] = df1[col].cat.set_categories(categories)
+            aligned2[col] = df2[col].cat.set_categories(categories)
+    return df1.assign(**aligned1), df2.assign(**aligned2)
 
-def pivot_to_long(pivot_df: pd.DataFrame) -> pd.DataFrame:
+def aggregate_to_long(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Convert the wide pivot table to a long format for merging and comparison.
-    Uses stacking if columns are MultiIndex; otherwise uses melt.
+    Sum the 'Amount' per Date, Currency, Exchange and Type in long format,
+    so the two files can be compared without building a wide pivot table first.
     """
     try:
-        if isinstance(pivot_df.columns, pd.MultiIndex):
-            long_df = pivot_df.set_index(['Date', 'Currency']).stack(level=[0, 1]).reset_index(name='Amount')
-            long_df.columns = ['Date', 'Currency', 'Exchange', 'Type', 'Amount']
-        else:
-            required_cols = ['Date', 'Currency']
-            missing = [col for col in required_cols if col not in pivot_df.columns]
-            if missing:
-                raise KeyError(f"Missing expected columns for melting: {missing}. Found columns: {pivot_df.columns.tolist()}")
-            long_df = pivot_df.melt(id_vars=required_cols, var_name='Exchange_Type', value_name='Amount')
-            if 'Exchange_Type' in long_df.columns:
-                if long_df['Exchange_Type'].dtype == object and '_' in long_df['Exchange_Type'].iloc[0]:
-                    long_df[['Exchange', 'Type']] = long_df['Exchange_Type'].str.split('_', expand=True)
-                    long_df.drop(columns=['Exchange_Type'], inplace=True)
-                else:
-                    raise ValueError("Cannot split 'Exchange_Type' column into 'Exchange' and 'Type'.")
-        return long_df
+        return df.groupby(KEY_COLUMNS, as_index=False, sort=False, observed=True)['Amount'].sum()
     except Exception as e:
-        st.error(f"Error converting pivot table to long format: {e}")
+        st.error(f"Error aggregating data: {e}")
         raise
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def create_pivot_table(digest: str, _df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Create a pivot table that sums the 'Amount' per Date and Currency,
+    with separate columns for each combination of Exchange and Type.
+    """
+    # Sum once in the groupby, then unstack and pad with zeros in the same reshape
+    pivot_df = (
+        aggregate_to_long(_df)
+        .set_index(KEY_COLUMNS)['Amount']
+        .unstack(['Exchange', 'Type'], fill_value=0)
+        .sort_index(axis=1)
+    )
+    # Plain column labels: categorical column levels don't survive the Arrow round-trip to the browser
+    pivot_df.columns = pd.MultiIndex.from_tuples(pivot_df.columns.tolist(), names=pivot_df.columns.names)
+    # Date and Currency stay as the index; st.dataframe shows it without flattening into columns
+    return pivot_df
+
+def encode_keys(long_df1: pd.DataFrame, long_df2: pd.DataFrame):
+    """
+    Encode Date, Currency, Exchange and Type into a single int64 key per row.
+    Both frames are factorized together so equal keys get equal codes, and the
+    codes are sorted so the combined key orders rows like the original columns.
+    Returns the two key arrays and the unique values of each key column.
+    """
+    both = pd.concat([long_df1[KEY_COLUMNS], long_df2[KEY_COLUMNS]], ignore_index=True)
+    key = np.zeros(len(both), dtype=np.int64)
+    uniques = []
+    for col in KEY_COLUMNS:
+        codes, col_uniques = pd.factorize(both[col], sort=True)
+        key = key * len(col_uniques) + codes
+        uniques.append(col_uniques)
+    return key[:len(long_df1)], key[len(long_df1):], uniques
+
+def decode_keys(key: np.ndarray, uniques: list) -> pd.DataFrame:
+    """
+    Rebuild the Date, Currency, Exchange and Type columns from encoded keys.
+    """
+    columns = {}
+    for col, col_uniques in reversed(list(zip(KEY_COLUMNS, uniques))):
+        key, codes = np.divmod(key, len(col_uniques))
+        columns[col] = col_uniques.take(codes)
+    return pd.DataFrame({col: columns[col] for col in KEY_COLUMNS})
+
 def merge_and_calculate_gap(long_df1: pd.DataFrame, long_df2: pd.DataFrame) -> pd.DataFrame:
     """
-    Merge two long-format pivot tables and calculate the gap between amounts.
-    The merge is done on Date, Currency, Exchange, and Type.
+    Combine two long-format tables and calculate the gap between amounts.
+    Rows are matched on Date, Currency, Exchange, and Type, combined into one
+    integer key; a single groupby-sum over both files replaces an outer merge
+    followed by filling the missing side with zeros.
     """
     try:
-        merged_df = pd.merge(
-            long_df1, long_df2,
-            on=['Date', 'Currency', 'Exchange', 'Type'],
-            how='outer',
-            suffixes=('_file1', '_file2')
-        )
-        merged_df['Amount_file1'] = merged_df['Amount_file1'].fillna(0)
-        merged_df['Amount_file2'] = merged_df['Amount_file2'].fillna(0)
+        key1, key2, uniques = encode_keys(long_df1, long_df2)
+        amount1 = long_df1['Amount'].to_numpy()
+        amount2 = long_df2['Amount'].to_numpy()
+        both = pd.DataFrame({
+            '_k': np.concatenate([key1, key2]),
+            'Amount_file1': np.concatenate([amount1, np.zeros_like(amount2)]),
+            'Amount_file2': np.concatenate([np.zeros_like(amount1), amount2]),
+        })
+        sums = both.groupby('_k', sort=True).sum()
+        merged_df = decode_keys(sums.index.to_numpy(), uniques)
+        merged_df['Amount_file1'] = sums['Amount_file1'].to_numpy()
+        merged_df['Amount_file2'] = sums['Amount_file2'].to_numpy()
         merged_df['Gap'] = merged_df['Amount_file1'] - merged_df['Amount_file2']
         return merged_df
     except Exception as e:
-        st.error(f"Error merging pivot tables: {e}")
+        st.error(f"Error calculating gaps: {e}")
         raise
 
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def compute_gap_views(digest1: str, digest2: str, _df1: pd.DataFrame, _df2: pd.DataFrame):
+    """
+    Calculate the gap table once and return it together with the subset of
+    rows that have a non-zero gap, so toggling the filter only picks a view.
+    """
+    df1, df2 = align_categories(_df1, _df2)
+    gap_df = merge_and_calculate_gap(aggregate_to_long(df1), aggregate_to_long(df2))
+    nonzero = gap_df['Gap'].to_numpy() != 0
+    # When every row has a gap the filter keeps everything, so reuse the frame instead of copying it
+    return gap_df, gap_df if nonzero.all() else gap_df[nonzero]
+
 # ---------------------------
 # Main Streamlit App
 # ---------------------------
@@ -100,34 +316,44 @@ def main():
     uploaded_file2 = st.file_uploader("Upload the second Excel file", type=["xlsx", "xls"], key="file2")
     
     if uploaded_file1 is not None and uploaded_file2 is not None:
-        # Load data from each file
-        df1 = load_excel_data(uploaded_file1)
-        df2 = load_excel_data(uploaded_file2)
+        # Load data from both files in parallel
+        (digest1, df1), (digest2, df2) = load_excel_files(uploaded_file1, uploaded_file2)
         
         st.success("Both files uploaded and processed successfully!")
         
         # Display data period for each file.
-        st.write(f"**File 1 Period:** {df1['Date'].min()} to {df1['Date'].max()}")
-        st.write(f"**File 2 Period:** {df2['Date'].min()} to {df2['Date'].max()}")
-        
-        # Generate pivot tables for each file.
-        pivot_df1 = create_pivot_table(df1)
-        pivot_df2 = create_pivot_table(df2)
+        start1, end1 = get_date_bounds(digest1, df1)
+        start2, end2 = get_date_bounds(digest2, df2)
+        st.write(f"**File 1 Period:** {start1} to {end1}")
+        st.write(f"**File 2 Period:** {start2} to {end2}")
         
-        # Convert pivot tables to long format.
-        long_df1 = pivot_to_long(pivot_df1)
-        long_df2 = pivot_to_long(pivot_df2)
-        
-        # Merge the two long DataFrames and calculate gaps.
-        gap_df = merge_and_calculate_gap(long_df1, long_df2)
+        # Aggregate each file to long format and calculate gaps.
+        gap_df, nonzero_gap_df = compute_gap_views(digest1, digest2, df1, df2)
         
         # Add a checkbox for filtering rows with non-zero gap.
         show_only_nonzero = st.checkbox("Show only rows with a non-zero gap", value=False)
         if show_only_nonzero:
-            gap_df = gap_df[gap_df['Gap'] != 0]
+            gap_df = nonzero_gap_df
         
         st.subheader("Gaps Between File 1 and File 2")
-        st.dataframe(gap_df)
+        # Only a preview is sent to the browser; the full table is generated on download.
+        st.dataframe(gap_df.head(PREVIEW_ROWS), column_config=DATE_COLUMN_CONFIG)
+        if len(gap_df) > PREVIEW_ROWS:
+            st.caption(f"Showing the first {PREVIEW_ROWS:,} of {len(gap_df):,} rows.")
+        st.download_button(
+            "Download full gap table",
+            data=lambda: gap_df.to_parquet(index=False),
+            file_name="gaps.parquet",
+            mime="application/vnd.apache.parquet"
+        )
+        
+        # The wide pivot tables are for display only, so build them on request.
+        with st.expander("Pivot tables per file"):
+            if st.checkbox("Build pivot tables", value=False):
+                st.write("**File 1**")
+                st.dataframe(create_pivot_table(digest1, df1).head(PREVIEW_ROWS), column_config=DATE_COLUMN_CONFIG)
+                st.write("**File 2**")
+                st.dataframe(create_pivot_table(digest2, df2).head(PREVIEW_ROWS), column_config=DATE_COLUMN_CONFIG)
     else:
         st.info("Please upload both Excel files to get started.")
 